@@ -1,5 +1,8 @@
 import threading
 import weakref
+from collections import OrderedDict
+from inspect import CO_VARKEYWORDS
+from types import FunctionType, MethodType
 
 from django.utils.inspect import func_accepts_kwargs
 
@@ -10,6 +13,12 @@ def _make_id(target):
     :param target:
     :return:
     """
+    # 先通过类型判断处理最常见的对象方法和函数，避免hasattr内部的异常处理开销
+    target_type = type(target)
+    if target_type is MethodType:
+        return id(target.__self__), id(target.__func__)
+    if target_type is FunctionType:
+        return id(target)
     if hasattr(target, '__func__'):
         # 注意如果是一个对象方法，则使用对象以及方法的组合作为ID
         return id(target.__self__), id(target.__func__)
@@ -17,6 +26,39 @@ def _make_id(target):
     return id(target)
 
 
+def _accepts_kwargs(receiver):
+    """
+    检查接收者是否可以接受**kwargs参数
+    :param receiver:
+    :return:
+    """
+    # 普通函数和绑定的普通函数直接通过代码对象的标志位判断，避免inspect.signature的开销。
+    # 绑定的是其他可调用对象的方法、被装饰过(__wrapped__)或者自定义了__signature__的对象，
+    # 没有代码对象或者签名与代码对象不一定一致，仍然使用通用的检查
+    if (type(receiver) in (FunctionType, MethodType) and
+            type(getattr(receiver, '__func__', receiver)) is FunctionType and
+            not hasattr(receiver, '__wrapped__') and not hasattr(receiver, '__signature__')):
+        return bool(receiver.__code__.co_flags & CO_VARKEYWORDS)
+    return func_accepts_kwargs(receiver)
+
+
+# django配置，第一次使用时才加载
+_settings = None
+
+
+def _get_settings():
+    """
+    获取django配置
+    :return:
+    """
+    # 不在模块顶部导入，避免循环导入，加载后缓存在模块中，之后直接返回
+    global _settings
+    if _settings is None:
+        from django.conf import settings
+        _settings = settings
+    return _settings
+
+
 # 空ID值
 NONE_ID = _make_id(None)
 
@@ -24,6 +66,14 @@ NONE_ID = _make_id(None)
 # 空对象表示没有接收者
 NO_RECEIVERS = object()
 
+# 没有可提供参数的信号共用的空集合
+_EMPTY_PROVIDING_ARGS = frozenset()
+
+# 实例不能被弱引用的sender类型(例如str、int)，第一次创建弱引用失败后记录下来，
+# 之后这些类型的sender在加锁前就跳过缓存，不需要每次都加锁并捕获TypeError。
+# 使用WeakSet，避免动态创建的类型(例如每次调用都创建的namedtuple类型)一直无法回收
+_UNWEAKREFABLE_TYPES = weakref.WeakSet()
+
 
 class Signal:
     """
@@ -35,6 +85,14 @@ class Signal:
             { receiverkey (id) : weakref(receiver) }
     """
 
+    # 使用__slots__减少每个信号实例的内存占用，同时加快属性的访问。
+    # 保留__weakref__使信号仍然可以被弱引用，子类没有定义__slots__时仍然拥有__dict__
+    __slots__ = (
+        'receivers', '_receiver_view', '_has_weak', '_has_sender_filter', 'providing_args',
+        'lock', 'use_caching', 'sender_receivers_cache', '_sender_refs', '_dead_receivers',
+        '_remove_receiver_callback', '__weakref__',
+    )
+
     def __init__(self, providing_args=None, use_caching=False):
         """
         Create a new signal.
@@ -43,13 +101,20 @@ class Signal:
             A list of the arguments this signal can pass along in a send() call.
         """
         # 接收者，是可以调用的对象，例如，函数、方法、可以调用对象__call__
-        self.receivers = []
+        # { lookup_key : receiver }，使用OrderedDict保持插入顺序，因此调用顺序与连接顺序一致，只在锁内修改。
+        # Python 3.7之前普通字典不保证顺序，lookup_key是(id, id)元组时会按哈希顺序调用
+        self.receivers = OrderedDict()
+        # receivers按列拆分后的快照 (sender key元组, receiver元组, 是否有弱引用, 是否有指定sender的receiver)，
+        # 修改receivers时只在锁内把快照置为None，下一次_live_receivers需要时再生成，保证connect/disconnect是O(1)的。
+        # 快照生成后不会再修改，这样_live_receivers读取时不需要加锁，
+        # 并且过滤时只需要遍历sender key，再根据快照的形态选择对应的处理方式
+        self._receiver_view = None
+        # 是否有弱引用的receiver，是否有指定了sender的receiver，connect时更新，生成快照时重新计算
+        self._has_weak = False
+        self._has_sender_filter = False
         # 信号可提供的参数,一般我们用于创建信号的时候创建
-        if providing_args is None:
-            providing_args = []
-
-        # 去重处理保证提可提供的参数唯一
-        self.providing_args = set(providing_args)
+        # 去重处理保证提可提供的参数唯一，创建后不会再修改，因此使用frozenset，没有参数时共用同一个空集合
+        self.providing_args = frozenset(providing_args) if providing_args else _EMPTY_PROVIDING_ARGS
         # 线程锁，保证添加或者删除修改信号方法的锁
         self.lock = threading.Lock()
         # 是否使用缓存，缺省不使用
@@ -58,11 +123,20 @@ class Signal:
         # A note about caching: if use_caching is defined, then for each
         # distinct sender we cache the receivers that sender has in
         # 'sender_receivers_cache'. The cache is cleaned when .connect() or
-        # .disconnect() is called and populated on send().
-        # 创建缓存，WeakKeyDictionary用于创建告诉缓存，防止缓存存在类似相互引用而导致缓存不能删除问题
-        self.sender_receivers_cache = weakref.WeakKeyDictionary() if use_caching else {}
+        # .disconnect() changes the receivers and populated on send(). Only the
+        # entry of the affected sender is dropped, unless the receiver applies
+        # to all senders.
+        # 创建缓存 { id(sender) : receivers }，使用普通的字典而不是WeakKeyDictionary，访问更快
+        self.sender_receivers_cache = {}
+        # { id(sender) : weakref(sender) }，sender被回收时通过弱引用的回调删除对应的缓存，
+        # 防止缓存存在类似相互引用而导致缓存不能删除问题，以及id被新的对象复用后取到错误的缓存
+        self._sender_refs = {}
         # 设置是否有以及消亡的接收者，例如某个线程结束后，那么这个接收者也就消失了.
         self._dead_receivers = False
+        # 所有弱引用receiver共用的回调，避免每次connect访问self._remove_receiver时都创建新的绑定方法对象。
+        # 第一次以弱引用connect时才创建，因为绑定方法引用了self，提前创建会让每个信号都处于循环引用中，
+        # 不能在引用计数为0时立即释放
+        self._remove_receiver_callback = None
 
     def connect(self, receiver, sender=None, weak=True, dispatch_uid=None):
         """
@@ -98,7 +172,7 @@ class Signal:
                 anything hashable.
         """
         # 加载django 配置
-        from django.conf import settings
+        settings = _get_settings()
 
         # If DEBUG is on, check that we got a good receiver
         # 检查接收者的合法性，必须是可被调用的。
@@ -108,40 +182,47 @@ class Signal:
 
             # Check for **kwargs
             # 接收者必须**kwargs定义来接受参数，要求我们定义星号处理方法必须是**kwargs
-            if not func_accepts_kwargs(receiver):
+            if not _accepts_kwargs(receiver):
                 raise ValueError("Signal receivers must accept keyword arguments (**kwargs).")
 
         # dispatch_uid 接收者身份ID，唯一的，通常是一个str类型
+        senderkey = _make_id(sender)
         if dispatch_uid:
-            lookup_key = (dispatch_uid, _make_id(sender))
+            lookup_key = (dispatch_uid, senderkey)
         else:
             # 注意查询key使用了receiver+sender的组合id作为key值
-            lookup_key = (_make_id(receiver), _make_id(sender))
+            lookup_key = (_make_id(receiver), senderkey)
 
         # weak默认值True，是否使用弱引用[另一个主题]，主要解决缓存对象回收问题
         if weak:
             ref = weakref.ref
-            receiver_object = receiver
             # Check for bound methods，检查是对象方法
             if hasattr(receiver, '__self__') and hasattr(receiver, '__func__'):
                 ref = weakref.WeakMethod
-                receiver_object = receiver.__self__
 
-            # 创建若引用receiver
-            receiver = ref(receiver)
-            # 注册一个回调处理方法，当receiver_object被垃圾回收期回收的时候，调用
+            # 创建弱引用receiver，同时注册回调处理方法，当receiver被垃圾回收期回收的时候，调用
             # _remove_receiver 标识下有receiver已经死亡，可以移除了。 主要是在多线程场景下面可能发生
-            weakref.finalize(receiver_object, self._remove_receiver)
+            callback = self._remove_receiver_callback
+            if callback is None:
+                callback = self._remove_receiver_callback = self._remove_receiver
+            receiver = ref(receiver, callback)
 
         # 加锁，添加receiver，到我们的列表中
         with self.lock:
-            # 清理已经死掉的receiver
-            self._clear_dead_receivers()
-            # 如果不存在则添加到列表
-            if not any(r_key == lookup_key for r_key, _ in self.receivers):
-                self.receivers.append((lookup_key, receiver))
-            # 清理缓存，因为我们新增内容了
-            self.sender_receivers_cache.clear()
+            # 清理已经死掉的receiver，没有死掉的receiver时不需要调用。
+            # 添加前必须清理，否则死掉的receiver的id被新的对象复用时，新的receiver会被当作已经存在而无法添加
+            if self._dead_receivers:
+                self._clear_dead_receivers()
+            # 如果不存在则添加，已经存在则保留原来的receiver
+            if lookup_key not in self.receivers:
+                self.receivers[lookup_key] = receiver
+                self._receiver_view = None
+                if weak:
+                    self._has_weak = True
+                if senderkey != NONE_ID:
+                    self._has_sender_filter = True
+                # 清理缓存，因为我们新增内容了
+                self._clear_sender_cache(senderkey)
 
     # 移除接收者从我们的信号中
     def disconnect(self, receiver=None, sender=None, dispatch_uid=None):
@@ -164,26 +245,26 @@ class Signal:
                 the unique identifier of the receiver to disconnect
         """
         # 生成lookup_key
+        senderkey = _make_id(sender)
         if dispatch_uid:
-            lookup_key = (dispatch_uid, _make_id(sender))
+            lookup_key = (dispatch_uid, senderkey)
         else:
-            lookup_key = (_make_id(receiver), _make_id(sender))
+            lookup_key = (_make_id(receiver), senderkey)
 
         # 设置默认值False
         disconnected = False
         # 加锁
         with self.lock:
-            # 清理死掉的receiver，我们可以提取清理一次死去的
-            self._clear_dead_receivers()
-            # 遍历判断如果是我们要删除的receiver则删除
-            for index in range(len(self.receivers)):
-                (r_key, _) = self.receivers[index]
-                if r_key == lookup_key:
-                    disconnected = True
-                    del self.receivers[index]
-                    break
-            # 清理缓存，保证我们缓存使用的是最新的
-            self.sender_receivers_cache.clear()
+            # 清理死掉的receiver，我们可以提取清理一次死去的，同样避免误删id被复用的死掉的receiver
+            if self._dead_receivers:
+                self._clear_dead_receivers()
+            # 如果是我们要删除的receiver则删除
+            if lookup_key in self.receivers:
+                disconnected = True
+                del self.receivers[lookup_key]
+                self._receiver_view = None
+                # 清理缓存，保证我们缓存使用的是最新的
+                self._clear_sender_cache(senderkey)
         # 返回disconnected 标志
         return disconnected
 
@@ -209,15 +290,24 @@ class Signal:
 
         Return a list of tuple pairs [(receiver, response), ... ].
         """
-        # 如果没有receivers 或者 没有找到对应的sender 则直接返回空
-        if not self.receivers or self.sender_receivers_cache.get(sender) is NO_RECEIVERS:
+        # 如果没有receivers 则直接返回空
+        if not self.receivers:
+            return []
+        # 只有开启缓存时才需要查询缓存，缓存中该sender没有对应的receiver则直接返回空
+        if self.use_caching and self.sender_receivers_cache.get(id(sender)) is NO_RECEIVERS:
             return []
 
+        receivers = self._live_receivers(sender)
+        if not receivers:
+            return []
+        # 一次性把signal和sender合并到参数中，避免每次调用receiver都重新合并参数。
+        # named是本次调用独有的字典，receiver接收到的**kwargs是解包后新建的字典，修改它不会影响其他receiver
+        if 'signal' in named:
+            raise TypeError("send() got multiple values for keyword argument 'signal'")
+        named['signal'] = self
+        named['sender'] = sender
         # 循环调用执行receiver
-        return [
-            (receiver, receiver(signal=self, sender=sender, **named))
-            for receiver in self._live_receivers(sender)
-        ]
+        return [(receiver, receiver(**named)) for receiver in receivers]
 
     # 与send的区别在于，这里面处理响应的异常，保证其他的接收则可以正常执行
     def send_robust(self, sender, **named):
@@ -241,16 +331,31 @@ class Signal:
         If any receiver raises an error (specifically any subclass of
         Exception), return the error instance as the result for that receiver.
         """
-        if not self.receivers or self.sender_receivers_cache.get(sender) is NO_RECEIVERS:
+        if not self.receivers:
+            return []
+        if self.use_caching and self.sender_receivers_cache.get(id(sender)) is NO_RECEIVERS:
             return []
 
+        receivers = self._live_receivers(sender)
+        if not receivers:
+            return []
+        # 与send()一样，一次性把signal和sender合并到参数中。
+        # 参数中已经有signal时每个receiver的调用都会出错，与之前一样把错误作为每个receiver的响应返回
+        if 'signal' in named:
+            return [
+                (receiver, TypeError("send_robust() got multiple values for keyword argument 'signal'"))
+                for receiver in receivers
+            ]
+        named['signal'] = self
+        named['sender'] = sender
+
         # Call each receiver with whatever arguments it can accept.
         # Return a list of tuple pairs [(receiver, response), ... ].
         responses = []
-        for receiver in self._live_receivers(sender):
+        for receiver in receivers:
             try:
                 # 尝试执行接收者任务
-                response = receiver(signal=self, sender=sender, **named)
+                response = receiver(**named)
             except Exception as err:
                 # 如果错误则把错误信息添加到响应中
                 responses.append((receiver, err))
@@ -265,12 +370,36 @@ class Signal:
         if self._dead_receivers:
             # 重新设置标志,为False
             self._dead_receivers = False
-            # 保留存活的 receivers，而不是删除死去的
-            self.receivers = [
-                r for r in self.receivers
-                # 如果不是引用类型 以及 已经销毁则说明死亡，取反后则说明剩下就是存活的。
-                if not (isinstance(r[1], weakref.ReferenceType) and r[1]() is None)
+            # 找出死掉的receiver，是引用类型 以及 已经销毁则说明死亡
+            dead_keys = [
+                r_key for r_key, r in self.receivers.items()
+                if isinstance(r, weakref.ReferenceType) and r() is None
             ]
+            if not dead_keys:
+                return
+            if len(dead_keys) * 2 < len(self.receivers):
+                # 死掉的receiver较少时直接从字典中删除，不需要复制整个字典
+                for r_key in dead_keys:
+                    del self.receivers[r_key]
+            else:
+                # 死掉的超过一半时保留存活的 receivers，重新创建字典可以释放删除后留下的空间
+                dead_keys = set(dead_keys)
+                self.receivers = OrderedDict(
+                    (r_key, r) for r_key, r in self.receivers.items() if r_key not in dead_keys
+                )
+            self._receiver_view = None
+
+    # 重新生成receivers的快照
+    def _update_receiver_view(self):
+        # Note: caller is assumed to hold self.lock.
+        sender_keys = tuple(r_senderkey for (_, r_senderkey) in self.receivers)
+        refs = tuple(self.receivers.values())
+        # disconnect以及清理死掉的receiver后标志可能已经不成立，只有标志为True时才需要重新计算
+        if self._has_weak:
+            self._has_weak = any(isinstance(r, weakref.ReferenceType) for r in refs)
+        if self._has_sender_filter:
+            self._has_sender_filter = any(r_senderkey != NONE_ID for r_senderkey in sender_keys)
+        self._receiver_view = (sender_keys, refs, self._has_weak, self._has_sender_filter)
 
     # 过滤获取存活的receiver
     def _live_receivers(self, sender):
@@ -280,50 +409,134 @@ class Signal:
         This checks for weak references and resolves them, then returning only
         live receivers.
         """
-        receivers = None
         # 如果有缓存，且没有死亡的接收则从缓存获取数据
         if self.use_caching and not self._dead_receivers:
-            receivers = self.sender_receivers_cache.get(sender)
+            cached = self.sender_receivers_cache.get(id(sender))
             # We could end up here with NO_RECEIVERS even if we do check this case in
             # .send() prior to calling _live_receivers() due to concurrent .send() call.
-            if receivers is NO_RECEIVERS:
+            if cached is NO_RECEIVERS:
                 return []
+            if cached is not None:
+                receivers, has_weak = cached
+                # 没有弱引用的缓存已经是解引用后的结果，直接返回
+                if not has_weak:
+                    return receivers
+                # 创建一个空列表用于保存正常的receiver便于调用使用
+                non_weak_receivers = []
+                for receiver in receivers:
+                    if isinstance(receiver, weakref.ReferenceType):
+                        # Dereference the weak reference.
+                        # 解弱引用，转化成常规对象
+                        receiver = receiver()
+                        if receiver is None:
+                            continue
+                    non_weak_receivers.append(receiver)
+                return non_weak_receivers
 
-        # 如果缓存中没有获取到
-        if receivers is None:
-            # 加锁
+        # 缓存中没有获取到，只有存在死掉的receiver 或者 receivers修改后还没有生成快照时才加锁处理
+        view = self._receiver_view
+        if self._dead_receivers or view is None:
             with self.lock:
-                # 清理死掉的receiver
                 self._clear_dead_receivers()
+                if self._receiver_view is None:
+                    self._update_receiver_view()
+                view = self._receiver_view
+        # 快照生成后不会再修改，获取后遍历不需要加锁
+        sender_keys, refs, view_has_weak, view_has_sender = view
+        # 根据快照的形态选择对应的处理方式，避免在循环中对每个receiver做重复的判断
+        if not view_has_weak:
+            # 没有弱引用，不需要解引用
+            has_weak = False
+            if not view_has_sender:
+                # 所有receiver都没有指定sender，全部匹配
+                non_weak_receivers = list(refs)
+            else:
+                senderkey = _make_id(sender)
+                non_weak_receivers = [
+                    refs[index] for index, r_senderkey in enumerate(sender_keys)
+                    if r_senderkey == NONE_ID or r_senderkey == senderkey
+                ]
+            receivers = non_weak_receivers
+        else:
+            # receivers保存原始的receiver(可能是弱引用)用于缓存，
+            # non_weak_receivers保存解引用后存活的receiver，一次遍历同时完成过滤和解引用
+            has_weak = False
+            non_weak_receivers = []
+            if not view_has_sender:
+                receivers = refs
+                for receiver in refs:
+                    if isinstance(receiver, weakref.ReferenceType):
+                        has_weak = True
+                        receiver = receiver()
+                        if receiver is None:
+                            continue
+                    non_weak_receivers.append(receiver)
+            else:
                 senderkey = _make_id(sender)
                 receivers = []
-                # 遍历获取存活的receiver
-                for (receiverkey, r_senderkey), receiver in self.receivers:
+                for index, r_senderkey in enumerate(sender_keys):
                     if r_senderkey == NONE_ID or r_senderkey == senderkey:
+                        receiver = refs[index]
                         receivers.append(receiver)
-                # 如果设置缓存，则把存活的receiver添加到缓存
-                if self.use_caching:
+                        if isinstance(receiver, weakref.ReferenceType):
+                            has_weak = True
+                            receiver = receiver()
+                            if receiver is None:
+                                continue
+                        non_weak_receivers.append(receiver)
+        # 如果设置缓存，则把存活的receiver添加到缓存，不能缓存的sender在加锁前就跳过
+        if self.use_caching and type(sender) not in _UNWEAKREFABLE_TYPES:
+            with self.lock:
+                # 期间有connect/disconnect修改了receivers，则结果已经过期，不能缓存
+                if self._receiver_view is view:
                     if not receivers:
-                        self.sender_receivers_cache[sender] = NO_RECEIVERS
+                        self._cache_receivers(sender, NO_RECEIVERS)
+                    elif has_weak:
+                        # Note, we must cache the weakref versions, caching the
+                        # resolved receivers would keep them alive.
+                        self._cache_receivers(sender, (receivers, True))
                     else:
-                        # Note, we must cache the weakref versions.
-                        self.sender_receivers_cache[sender] = receivers
-
-        # 创建一个空列表用于保存正常的receiver便于调用使用
-        non_weak_receivers = []
-        for receiver in receivers:
-            if isinstance(receiver, weakref.ReferenceType):
-                # Dereference the weak reference.
-                # 解弱引用，转化成常规对象
-                receiver = receiver()
-                if receiver is not None:
-                    # 如果返回不是None则添加到列表中
-                    non_weak_receivers.append(receiver)
-            else:
-                non_weak_receivers.append(receiver)
+                        # Receivers without weakrefs are already resolved and
+                        # are cached (and shared between callers) as is.
+                        self._cache_receivers(sender, (non_weak_receivers, False))
         # 返回常规的receivers 便于我们下一步继续使用
         return non_weak_receivers
 
+    # 清理受影响的sender的缓存
+    def _clear_sender_cache(self, senderkey):
+        # Note: caller is assumed to hold self.lock.
+        if senderkey == NONE_ID or type(senderkey) is tuple:
+            # 没有指定sender的receiver对所有sender都生效，需要清理全部缓存；
+            # 对象方法作为sender时缓存的key(id(sender))与sender key不同，同样清理全部缓存
+            self.sender_receivers_cache.clear()
+        else:
+            # 其他情况sender key就是id(sender)，只删除这个sender的缓存
+            self.sender_receivers_cache.pop(senderkey, None)
+
+    # 把sender对应的receivers添加到缓存
+    def _cache_receivers(self, sender, receivers):
+        # Note: caller is assumed to hold self.lock.
+        sender_id = id(sender)
+        # None不会被回收，id也不会被复用，不需要弱引用就可以直接缓存
+        if sender is not None and sender_id not in self._sender_refs:
+            # 回调只引用这两个字典而不是self，避免 self -> _sender_refs -> 弱引用 -> 回调 -> self 的循环引用
+            sender_refs = self._sender_refs
+            sender_receivers_cache = self.sender_receivers_cache
+
+            def remove(ref, sender_id=sender_id):
+                # 与_remove_receiver一样，回调是垃圾回收的副作用，可能在已经持有self.lock时发生，因此这里不加锁
+                if sender_refs.get(sender_id) is ref:
+                    del sender_refs[sender_id]
+                    sender_receivers_cache.pop(sender_id, None)
+
+            try:
+                sender_refs[sender_id] = weakref.ref(sender, remove)
+            except TypeError:
+                # sender不能被弱引用(例如str、int)，无法知道它何时被回收，因此不缓存，并记录它的类型
+                _UNWEAKREFABLE_TYPES.add(type(sender))
+                return
+        self.sender_receivers_cache[sender_id] = receivers
+
     def _remove_receiver(self, receiver=None):
         # Mark that the self.receivers list has dead weakrefs. If so, we will
         # clean those up in connect, disconnect and _live_receivers while
@@ -0,0 +1,594 @@
+import collections
+import functools
+import gc
+import threading
+import types
+import weakref
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+try:
+    import django
+except ImportError:
+    django = None
+else:
+    import django.conf
+    from django.test.utils import override_settings
+
+    import django_signal_source
+
+
+def receiverA(sender, **kwargs):
+    """A test standalone receiver"""
+    return 'A'
+
+
+def receiverB(sender, **kwargs):
+    """Another test standalone receiver"""
+    return 'B'
+
+
+def receiverC(sender, **kwargs):
+    """Another test standalone receiver"""
+    return 'C'
+
+
+class DummySender(object):
+    """A dummy class to send signals from"""
+
+
+class OtherSender(object):
+    """Another dummy class to send signals from"""
+
+
+def responses(result):
+    """Strip the receivers from a send() result"""
+    return [response for _, response in result]
+
+
+@unittest.skipIf(django is None, "django is not installed")
+class ReceiverBookkeepingTest(unittest.TestCase):
+    """Unit tests for connecting and disconnecting receivers"""
+
+    def test_ConnectDuplicate(self):
+        """Test that each receiver connection is unique"""
+        signal = django_signal_source.Signal()
+        signal.connect(receiverA)
+        signal.connect(receiverA)
+        self.assertEqual(len(signal.receivers), 1, "Expected single connected receiver")
+        self.assertEqual(responses(signal.send(None)), ['A'])
+
+    def test_ConnectDuplicateDispatchUid(self):
+        """Test that a dispatch_uid is only connected once"""
+        signal = django_signal_source.Signal()
+        signal.connect(receiverA, dispatch_uid='uid')
+        signal.connect(receiverB, dispatch_uid='uid')
+        self.assertEqual(responses(signal.send(None)), ['A'])
+
+    def test_DisconnectKeepsOrder(self):
+        """Test disconnecting a receiver in the middle keeps the others in connection order"""
+        signal = django_signal_source.Signal()
+        signal.connect(receiverA)
+        signal.connect(receiverB)
+        signal.connect(receiverC)
+        self.assertTrue(signal.disconnect(receiverB))
+        self.assertEqual(responses(signal.send(None)), ['A', 'C'])
+        signal.connect(receiverB)
+        self.assertEqual(responses(signal.send(None)), ['A', 'C', 'B'])
+        self.assertTrue(signal.disconnect(receiverA))
+        self.assertTrue(signal.disconnect(receiverC))
+        self.assertEqual(responses(signal.send(None)), ['B'])
+
+    def test_DisconnectUnconnected(self):
+        """Test disconnecting an unconnected receiver"""
+        signal = django_signal_source.Signal()
+        signal.connect(receiverA)
+        self.assertFalse(signal.disconnect(receiverB))
+        self.assertFalse(signal.disconnect(receiverA, sender=DummySender))
+        self.assertEqual(responses(signal.send(None)), ['A'])
+
+    def test_DisconnectDispatchUid(self):
+        """Test disconnecting by dispatch_uid"""
+        signal = django_signal_source.Signal()
+        signal.connect(receiverA, dispatch_uid='uid')
+        self.assertTrue(signal.disconnect(dispatch_uid='uid'))
+        self.assertEqual(signal.send(None), [])
+
+    def test_ManyReceivers(self):
+        """Test connecting and disconnecting many receivers"""
+        signal = django_signal_source.Signal()
+        receivers = []
+        for index in range(200):
+            def receiver(sender, index=index, **kwargs):
+                return index
+            receivers.append(receiver)
+            signal.connect(receiver)
+        for receiver in receivers[::2]:
+            self.assertTrue(signal.disconnect(receiver))
+        self.assertEqual(responses(signal.send(None)), list(range(1, 200, 2)))
+
+    def test_HasListeners(self):
+        """Test has_listeners follows connect and disconnect"""
+        signal = django_signal_source.Signal()
+        self.assertFalse(signal.has_listeners())
+        signal.connect(receiverA, sender=DummySender)
+        self.assertTrue(signal.has_listeners(DummySender))
+        self.assertFalse(signal.has_listeners(OtherSender))
+        signal.disconnect(receiverA, sender=DummySender)
+        self.assertFalse(signal.has_listeners(DummySender))
+
+    def test_DeadReceiver(self):
+        """Test that a deleted receiver is no longer called"""
+        signal = django_signal_source.Signal()
+
+        def toDelete(sender, **kwargs):
+            return 'deleted'
+
+        signal.connect(receiverA)
+        signal.connect(toDelete)
+        del toDelete
+        gc.collect()
+        self.assertEqual(responses(signal.send(None)), ['A'])
+        self.assertEqual(len(signal.receivers), 1)
+
+    def test_DeadReceiversKeepOrder(self):
+        """Test that removing most receivers as dead keeps the order of the others"""
+        signal = django_signal_source.Signal()
+        toDelete = []
+        for index in range(3):
+            def receiver(sender, **kwargs):
+                return 'deleted'
+            toDelete.append(receiver)
+            signal.connect(receiver)
+        signal.connect(receiverC, sender=DummySender)
+        signal.connect(receiverB, sender=DummySender)
+        signal.connect(receiverA, sender=DummySender)
+        del toDelete[:], receiver
+        gc.collect()
+        self.assertEqual(responses(signal.send(DummySender)), ['C', 'B', 'A'])
+        self.assertIsInstance(signal.receivers, collections.OrderedDict)
+
+
+@unittest.skipIf(django is None, "django is not installed")
+class SignalLifetimeTest(unittest.TestCase):
+    """Unit tests for freeing signals"""
+
+    def test_FreedWithoutReceivers(self):
+        """Test a signal without receivers is freed as soon as it is deleted"""
+        signal = django_signal_source.Signal()
+        signalRef = weakref.ref(signal)
+        del signal
+        self.assertIsNone(signalRef())
+
+    def test_Slots(self):
+        """Test a signal has no instance __dict__ but can still be weakly referenced"""
+        signal = django_signal_source.Signal(providing_args=['value'], use_caching=True)
+        self.assertFalse(hasattr(signal, '__dict__'))
+        with self.assertRaises(AttributeError):
+            signal.unknown = True
+        self.assertIs(weakref.ref(signal)(), signal)
+
+    def test_FreedWithStrongReceivers(self):
+        """Test a signal with only strong receivers is freed as soon as it is deleted"""
+        for useCaching in (False, True):
+            signal = django_signal_source.Signal(use_caching=useCaching)
+            signal.connect(receiverA, weak=False)
+            signal.send(None)
+            signal.send(DummySender)
+            signalRef = weakref.ref(signal)
+            del signal
+            self.assertIsNone(signalRef())
+
+    def test_SharedRemoveCallback(self):
+        """Test weak receivers share a single dead-receiver callback"""
+        signal = django_signal_source.Signal()
+        signal.connect(receiverA)
+        signal.connect(receiverB)
+        callbacks = set(id(ref.__callback__) for ref in signal.receivers.values())
+        self.assertEqual(len(callbacks), 1)
+
+
+@unittest.skipIf(django is None, "django is not installed")
+class DispatchShapeTest(unittest.TestCase):
+    """Unit tests for dispatching with weak/strong and sender-bound receivers"""
+
+    def test_StrongReceivers(self):
+        """Test dispatching to strong receivers for any and specific senders"""
+        signal = django_signal_source.Signal()
+        signal.connect(receiverA, weak=False)
+        signal.connect(receiverB, weak=False)
+        self.assertEqual(responses(signal.send(DummySender)), ['A', 'B'])
+        signal.connect(receiverC, sender=DummySender, weak=False)
+        self.assertEqual(responses(signal.send(DummySender)), ['A', 'B', 'C'])
+        self.assertEqual(responses(signal.send(OtherSender)), ['A', 'B'])
+
+    def test_ShapeAfterDisconnect(self):
+        """Test dispatching after the last weak or sender-bound receiver is disconnected"""
+        signal = django_signal_source.Signal()
+        signal.connect(receiverA, weak=False)
+        signal.connect(receiverB)
+        signal.connect(receiverC, sender=DummySender, weak=False)
+        self.assertEqual(responses(signal.send(DummySender)), ['A', 'B', 'C'])
+        signal.disconnect(receiverB)
+        signal.disconnect(receiverC, sender=DummySender)
+        self.assertEqual(responses(signal.send(DummySender)), ['A'])
+        signal.connect(receiverC, sender=OtherSender)
+        self.assertEqual(responses(signal.send(DummySender)), ['A'])
+        self.assertEqual(responses(signal.send(OtherSender)), ['A', 'C'])
+
+    def test_MixedDeadReceiver(self):
+        """Test a deleted weak receiver between strong receivers is skipped"""
+        signal = django_signal_source.Signal()
+
+        def toDelete(sender, **kwargs):
+            return 'deleted'
+
+        signal.connect(receiverA, weak=False)
+        signal.connect(toDelete, sender=DummySender)
+        signal.connect(receiverB, weak=False)
+        self.assertEqual(responses(signal.send(DummySender)), ['A', 'deleted', 'B'])
+        del toDelete
+        gc.collect()
+        self.assertEqual(responses(signal.send(DummySender)), ['A', 'B'])
+
+
+@unittest.skipIf(django is None, "django is not installed")
+class SendArgumentsTest(unittest.TestCase):
+    """Unit tests for the keyword arguments passed to receivers"""
+
+    def test_ReceiverMutatesKwargs(self):
+        """Test a receiver writing into its **kwargs is not seen by the next receiver"""
+        signal = django_signal_source.Signal()
+        seen = []
+
+        def mutate(sender, **kwargs):
+            kwargs['value'] = 'changed'
+            kwargs['extra'] = True
+            del kwargs['signal']
+
+        def check(sender, **kwargs):
+            seen.append(dict(kwargs))
+
+        signal.connect(mutate)
+        signal.connect(check)
+        signal.send(DummySender, value='original')
+        self.assertEqual(seen, [{'signal': signal, 'value': 'original'}])
+
+    def test_SignalKeyword(self):
+        """Test sending a signal keyword raises a TypeError when there are live receivers"""
+        signal = django_signal_source.Signal()
+        called = []
+        signal.connect(lambda sender, **kwargs: called.append(sender), weak=False)
+        with self.assertRaises(TypeError):
+            signal.send(None, signal='other')
+        self.assertEqual(called, [])
+
+    def test_SignalKeywordNoReceivers(self):
+        """Test sending a signal keyword without live receivers returns no responses"""
+        signal = django_signal_source.Signal()
+        self.assertEqual(signal.send(None, signal='other'), [])
+        signal.connect(receiverA, sender=OtherSender)
+        self.assertEqual(signal.send(None, signal='other'), [])
+
+    def test_RobustSignalKeyword(self):
+        """Test send_robust with a signal keyword returns a TypeError for each live receiver"""
+        signal = django_signal_source.Signal()
+        called = []
+
+        def receiver(sender, **kwargs):
+            called.append(sender)
+
+        signal.connect(receiver)
+        signal.connect(receiverA, weak=False)
+        signal.connect(receiverB, sender=OtherSender)
+        result = signal.send_robust(DummySender, signal='other')
+        self.assertEqual([r for r, _ in result], [receiver, receiverA])
+        for _, err in result:
+            self.assertIsInstance(err, TypeError)
+        self.assertEqual(called, [])
+
+
+@unittest.skipIf(django is None, "django is not installed")
+class CachingTest(unittest.TestCase):
+    """Unit tests for signals created with use_caching"""
+
+    def setUp(self):
+        self.signal = django_signal_source.Signal(use_caching=True)
+
+    def test_CacheHit(self):
+        """Test repeated sends return the same receivers once cached"""
+        self.signal.connect(receiverA)
+        self.signal.connect(receiverB, weak=False)
+        for _ in range(3):
+            self.assertEqual(responses(self.signal.send(DummySender)), ['A', 'B'])
+        self.assertIn(id(DummySender), self.signal.sender_receivers_cache)
+
+    def test_NoReceiversCached(self):
+        """Test a sender without receivers is cached as having none"""
+        self.signal.connect(receiverA, sender=OtherSender)
+        self.assertEqual(self.signal.send(DummySender), [])
+        self.assertIs(self.signal.sender_receivers_cache[id(DummySender)],
+                      django_signal_source.NO_RECEIVERS)
+        self.assertEqual(self.signal.send(DummySender), [])
+        self.assertEqual(self.signal.send_robust(DummySender), [])
+
+    def test_WeakReceiverDies(self):
+        """Test a cached weak receiver is skipped once it is deleted"""
+        def toDelete(sender, **kwargs):
+            return 'deleted'
+
+        self.signal.connect(receiverA, weak=False)
+        self.signal.connect(toDelete)
+        self.assertEqual(responses(self.signal.send(DummySender)), ['A', 'deleted'])
+        del toDelete
+        gc.collect()
+        for _ in range(2):
+            self.assertEqual(responses(self.signal.send(DummySender)), ['A'])
+
+    def test_CacheDoesNotKeepWeakReceiverAlive(self):
+        """Test caching a weak receiver does not hold a strong reference to it"""
+        def toDelete(sender, **kwargs):
+            return 'deleted'
+
+        self.signal.connect(toDelete)
+        self.signal.send(DummySender)
+        self.signal.send(DummySender)
+        receiverRef = weakref.ref(toDelete)
+        del toDelete
+        gc.collect()
+        self.assertIsNone(receiverRef())
+
+    def test_SenderCollected(self):
+        """Test the cache entry of a sender is dropped when the sender is collected"""
+        self.signal.connect(receiverA)
+
+        class TempSender(object):
+            pass
+
+        senderId = id(TempSender)
+        self.assertEqual(responses(self.signal.send(TempSender)), ['A'])
+        self.assertIn(senderId, self.signal.sender_receivers_cache)
+        del TempSender
+        gc.collect()
+        self.assertNotIn(senderId, self.signal.sender_receivers_cache)
+        self.assertNotIn(senderId, self.signal._sender_refs)
+
+    def test_ManySendersCollected(self):
+        """Test fresh senders do not grow the cache or reuse each other's entries"""
+        self.signal.connect(receiverA)
+        self.signal.connect(receiverB, sender=DummySender)
+        for index in range(100):
+            sender = DummySender()
+            self.assertEqual(responses(self.signal.send(sender)), ['A'])
+            self.assertEqual(responses(self.signal.send(DummySender)), ['A', 'B'])
+            del sender
+        gc.collect()
+        self.assertEqual(list(self.signal.sender_receivers_cache), [id(DummySender)])
+
+    def test_InvalidateSender(self):
+        """Test connecting to one sender keeps the cache of other senders"""
+        self.signal.connect(receiverA)
+        self.signal.send(DummySender)
+        self.signal.send(OtherSender)
+        self.signal.connect(receiverB, sender=DummySender)
+        self.assertNotIn(id(DummySender), self.signal.sender_receivers_cache)
+        self.assertIn(id(OtherSender), self.signal.sender_receivers_cache)
+        self.assertEqual(responses(self.signal.send(DummySender)), ['A', 'B'])
+        self.assertEqual(responses(self.signal.send(OtherSender)), ['A'])
+        self.signal.disconnect(receiverB, sender=DummySender)
+        self.assertEqual(responses(self.signal.send(DummySender)), ['A'])
+
+    def test_InvalidateAll(self):
+        """Test connecting and disconnecting for all senders invalidates every sender"""
+        self.signal.connect(receiverA, sender=DummySender)
+        self.assertEqual(responses(self.signal.send(DummySender)), ['A'])
+        self.assertEqual(self.signal.send(OtherSender), [])
+        self.signal.connect(receiverB)
+        self.assertEqual(responses(self.signal.send(DummySender)), ['A', 'B'])
+        self.assertEqual(responses(self.signal.send(OtherSender)), ['B'])
+        self.signal.disconnect(receiverB)
+        self.assertEqual(responses(self.signal.send(DummySender)), ['A'])
+        self.assertEqual(self.signal.send(OtherSender), [])
+
+    def test_NoneSender(self):
+        """Test None is cached as a sender without a weak reference"""
+        self.signal.connect(receiverA)
+        self.signal.connect(receiverB, sender=DummySender)
+        for _ in range(2):
+            self.assertEqual(responses(self.signal.send(None)), ['A'])
+        self.assertIn(id(None), self.signal.sender_receivers_cache)
+        self.assertNotIn(id(None), self.signal._sender_refs)
+        self.signal.connect(receiverC)
+        self.assertEqual(responses(self.signal.send(None)), ['A', 'C'])
+
+    def test_UnweakrefableSender(self):
+        """Test senders that cannot be weakly referenced are not cached"""
+        self.signal.connect(receiverA)
+        for _ in range(2):
+            self.assertEqual(responses(self.signal.send(1)), ['A'])
+            self.assertEqual(responses(self.signal.send_robust('sender')), ['A'])
+        self.assertEqual(self.signal.sender_receivers_cache, {})
+        self.assertIn(int, django_signal_source._UNWEAKREFABLE_TYPES)
+        self.assertIn(str, django_signal_source._UNWEAKREFABLE_TYPES)
+
+    def test_UnweakrefableSenderTypeFreed(self):
+        """Test recording a sender type that cannot be weakly referenced does not keep it alive"""
+        self.signal.connect(receiverA)
+        Point = collections.namedtuple('Point', 'x y')
+        self.assertEqual(responses(self.signal.send(Point(1, 2))), ['A'])
+        self.assertIn(Point, django_signal_source._UNWEAKREFABLE_TYPES)
+        typeRef = weakref.ref(Point)
+        del Point
+        gc.collect()
+        self.assertIsNone(typeRef())
+
+
+@unittest.skipIf(django is None, "django is not installed")
+class ConcurrentDispatchTest(unittest.TestCase):
+    """Unit tests for sending while other threads connect and disconnect"""
+
+    def _churn(self, signal):
+        """Connect, send and disconnect from several threads at once"""
+        errors = []
+
+        def work():
+            try:
+                for index in range(200):
+                    def receiver(sender, **kwargs):
+                        return 'temp'
+                    signal.connect(receiver, sender=DummySender)
+                    signal.send(DummySender)
+                    signal.send_robust(None)
+                    signal.disconnect(receiver, sender=DummySender)
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_Concurrent(self):
+        """Test the receivers are consistent after concurrent connect/send/disconnect"""
+        signal = django_signal_source.Signal()
+        signal.connect(receiverA)
+        self._churn(signal)
+        self.assertEqual(responses(signal.send(DummySender)), ['A'])
+        self.assertEqual(len(signal.receivers), 1)
+
+    def test_ConcurrentCaching(self):
+        """Test no stale cache entries survive concurrent connect/send/disconnect"""
+        signal = django_signal_source.Signal(use_caching=True)
+        signal.connect(receiverA)
+        self._churn(signal)
+        self.assertEqual(responses(signal.send(DummySender)), ['A'])
+        self.assertEqual(responses(signal.send(DummySender)), ['A'])
+
+    def test_NoCacheFillFromStaleSnapshot(self):
+        """Test a send racing with connect does not cache its outdated receivers"""
+        signal = django_signal_source.Signal(use_caching=True)
+        signal.connect(receiverA)
+        signal.connect(receiverC, sender=OtherSender)
+
+        # Emulate the race deterministically: connect between taking the receivers
+        # snapshot and filling the cache, while the sender key is computed
+        original = django_signal_source._make_id
+
+        def make_id(target):
+            if target is DummySender:
+                django_signal_source._make_id = original
+                signal.connect(receiverB, sender=DummySender)
+            return original(target)
+
+        django_signal_source._make_id = make_id
+        try:
+            self.assertEqual(responses(signal.send(DummySender)), ['A'])
+        finally:
+            django_signal_source._make_id = original
+        self.assertEqual(responses(signal.send(DummySender)), ['A', 'B'])
+
+
+@unittest.skipIf(django is None, "django is not installed")
+class DebugConnectTest(unittest.TestCase):
+    """Unit tests for the receiver checks done by connect when DEBUG is on"""
+
+    @classmethod
+    def setUpClass(cls):
+        # Settings can only be configured once per process, keep DEBUG off outside these tests
+        if not django.conf.settings.configured:
+            django.conf.settings.configure(DEBUG=False)
+
+    def test_SettingsResolvedOnce(self):
+        """Test connect uses django.conf.settings"""
+        self.assertIs(django_signal_source._get_settings(), django.conf.settings)
+        self.assertIs(django_signal_source._get_settings(), django.conf.settings)
+
+    def test_RejectsReceiverWithoutKwargs(self):
+        """Test connect rejects a receiver without **kwargs when DEBUG is on"""
+        def noKwargs(sender):
+            pass
+
+        signal = django_signal_source.Signal()
+        with override_settings(DEBUG=True):
+            with self.assertRaises(ValueError):
+                signal.connect(noKwargs)
+            signal.connect(receiverA)
+        self.assertEqual(len(signal.receivers), 1)
+        self.assertEqual(responses(signal.send(None)), ['A'])
+
+    def test_DebugOff(self):
+        """Test connect does not check receivers when DEBUG is off"""
+        def noKwargs(sender):
+            pass
+
+        signal = django_signal_source.Signal()
+        signal.connect(noKwargs)
+        self.assertEqual(len(signal.receivers), 1)
+
+
+@unittest.skipIf(django is None, "django is not installed")
+class AcceptsKwargsTest(unittest.TestCase):
+    """Unit tests for the **kwargs check done on connect"""
+
+    def assertSameAsDjango(self, receiver):
+        """Check the fast path agrees with django's func_accepts_kwargs"""
+        self.assertEqual(django_signal_source._accepts_kwargs(receiver),
+                         django_signal_source.func_accepts_kwargs(receiver))
+
+    def test_Function(self):
+        """Test plain functions with and without **kwargs"""
+        def noKwargs(sender):
+            pass
+
+        self.assertTrue(django_signal_source._accepts_kwargs(receiverA))
+        self.assertFalse(django_signal_source._accepts_kwargs(noKwargs))
+
+    def test_Method(self):
+        """Test bound methods with and without **kwargs"""
+        class Receiver(object):
+            def withKwargs(self, sender, **kwargs):
+                pass
+
+            def noKwargs(self, sender):
+                pass
+
+        self.assertTrue(django_signal_source._accepts_kwargs(Receiver().withKwargs))
+        self.assertFalse(django_signal_source._accepts_kwargs(Receiver().noKwargs))
+
+    def test_MethodWrappingCallable(self):
+        """Test a method bound to a callable object that is not a function"""
+        class CallableReceiver(object):
+            def __call__(self, instance, sender, **kwargs):
+                pass
+
+        receiver = types.MethodType(CallableReceiver(), DummySender())
+        self.assertSameAsDjango(receiver)
+
+    def test_Wrapped(self):
+        """Test a decorated receiver uses the signature of the wrapped function"""
+        def noKwargs(sender):
+            pass
+
+        @functools.wraps(noKwargs)
+        def wrapper(*args, **kwargs):
+            pass
+
+        self.assertSameAsDjango(wrapper)
+
+    def test_Callables(self):
+        """Test other callables fall back to func_accepts_kwargs"""
+        class CallableReceiver(object):
+            def __call__(self, sender, **kwargs):
+                pass
+
+        self.assertSameAsDjango(CallableReceiver())
+        self.assertSameAsDjango(functools.partial(receiverA, None))
+
+
+if __name__ == '__main__':
+    unittest.main()